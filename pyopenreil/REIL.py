@@ -60,6 +60,8 @@ def get_arch(arch):
 
 class Arg(object):
 
+    __slots__ = ( 'type', 'size', 'name', 'val' )
+
     def __init__(self, t = None, size = None, name = None, val = None):
 
         serialized = None        
@@ -310,7 +312,7 @@ class Insn(object):
         self.addr, self.inum, self.size = Insn_addr(data), Insn_inum(data), Insn_size(data)
 
         self.op = Insn_op(data)
-        if self.op > len(REIL_INSN) - 1: 
+        if not self.op in REIL_INSN: 
 
             raise ParseError(self.addr)
 
@@ -1621,7 +1623,15 @@ class DFGraph(Graph):
         def _evaluate(node): 
 
             insn = node.item
-            val = Math(insn.a, insn.b).eval(insn.op)
+
+            try: 
+
+                val = Math(insn.a, insn.b).eval(insn.op)
+
+            except ZeroDivisionError:
+
+                # leave division by zero as is, it will fail at run time
+                return None
 
             if val is not None:
 
@@ -1656,10 +1666,10 @@ class DFGraph(Graph):
                 node_next = edge.node_to
                 insn_next = node_next.item
 
-                if insn_next.op == I_UNK:
+                if node_next == self.exit_node or insn_next.op == I_UNK:
 
                     # Don't eliminate current instruction if any I_UNK
-                    # instructions uses it's results.
+                    # instructions or DFG exit node uses it's results.
                     return False
 
             for edge in node.out_edges:
@@ -1696,7 +1706,7 @@ class DFGraph(Graph):
 
                 # evaluate constant expression
                 arg = _evaluate(node)
-                if arg is None: 
+                if arg is not None: 
                 
                     # propagate constants information
                     if _propagate_do(node, arg):
@@ -2150,6 +2160,55 @@ class TestDFGraphBuilder(unittest.TestCase):
                                              a = Arg(A_CONST, U1, val = 1), 
                                              c = Arg(A_TEMP, U32, 'V_01')) ]
 
+    def test_constant_folding(self):
+
+        reg = lambda name: Arg(A_REG, U32, name)
+        temp = lambda name: Arg(A_TEMP, U32, name)
+        const = lambda val: Arg(A_CONST, U32, val = val)
+
+        code = [ [ ( I_ADD, const(5), const(1), temp('V_00') ),
+                   ( I_STR, temp('V_00'), Arg(), reg('R_EAX') ) ],
+                 [ ( I_DIV, const(1), const(0), temp('V_00') ),
+                   ( I_STR, temp('V_00'), Arg(), reg('R_EDX') ) ],
+                 [ ( I_STR, const(0), Arg(), temp('V_00') ),
+                   ( I_JCC, Arg(A_CONST, U1, val = 1), Arg(), reg('R_ECX') ) ] ]
+
+        # add test data to the storage
+        self.storage.clear()
+
+        for addr, insn_list in enumerate(code):
+
+            for inum, ( op, a, b, c ) in enumerate(insn_list):
+
+                insn = Insn(op = op, size = 1, ir_addr = ( addr, inum ), a = a, b = b, c = c)
+                if inum == len(insn_list) - 1: insn.set_flag(IOPT_ASM_END)
+
+                self.storage.put_insn(insn)
+
+        insn.set_flag(IOPT_BB_END)
+        insn.set_flag(IOPT_RET)
+        self.storage.put_insn(insn)
+
+        # construct DFG and fold constants
+        dfg = DFGraphBuilder(self.storage).traverse(0)
+        dfg.constant_folding()
+
+        storage = CodeStorageMem(self.arch)
+        dfg.store(storage)
+
+        print '\n', storage
+
+        # constant expression must be folded
+        assert storage.get_insn(0) == [ Insn(op = I_STR, ir_addr = ( 0, 0 ), 
+                                             a = const(6), c = reg('R_EAX')) ]
+
+        # division by zero can't be evaluated and must be left as is
+        assert storage.get_insn(1) == [ Insn(op = I_DIV, ir_addr = ( 1, 0 ), 
+                                             a = const(1), b = const(0), c = temp('V_00')),
+
+                                        Insn(op = I_STR, ir_addr = ( 1, 1 ), 
+                                             a = temp('V_00'), c = reg('R_EDX')) ]
+
 
 class Reader(object):
 
@@ -2191,6 +2250,10 @@ class CodeStorage(object):
 
     reader = None
 
+    # changes when stored IR code was modified or deleted,
+    # None if storage doesn't track changes of it's contents
+    version = None
+
     @abstractmethod
     def get_insn(self, ir_addr): pass
 
@@ -2206,6 +2269,8 @@ class CodeStorage(object):
 
 class CodeStorageMem(CodeStorage):    
 
+    version = 0
+
     def __init__(self, arch, insn_list = None, from_file = None): 
 
         self.clear()
@@ -2241,10 +2306,18 @@ class CodeStorageMem(CodeStorage):
     def _put_insn(self, insn):
 
         self.items[self._get_key(insn)] = insn        
+
+    def _has_insn(self, ir_addr):
+
+        try: self._get_insn(ir_addr)
+        except StorageError: return False
+
+        return True
     
     def clear(self): 
 
         self.items = {}
+        self.version += 1
 
     def size(self): 
 
@@ -2293,6 +2366,8 @@ class CodeStorageMem(CodeStorage):
             # delete single IR instruction
             self._del_insn(ir_addr)
 
+        self.version += 1
+
     def put_insn(self, insn_or_insn_list): 
 
         get_data = lambda insn: insn.serialize() if isinstance(insn, Insn) else insn
@@ -2300,12 +2375,20 @@ class CodeStorageMem(CodeStorage):
         if isinstance(insn_or_insn_list, list):
 
             # store instructions list
-            for insn in insn_or_insn_list: self._put_insn(get_data(insn))
+            insn_list = map(get_data, insn_or_insn_list)
 
         else:
 
             # store single IR instruction
-            self._put_insn(get_data(insn_or_insn_list))      
+            insn_list = [ get_data(insn_or_insn_list) ]
+
+        for insn in insn_list:
+
+            # adding of the new instructions doesn't modify existing code
+            exists = self._has_insn(( Insn_addr(insn), Insn_inum(insn) ))
+            self._put_insn(insn)
+
+            if exists: self.version += 1
 
     def to_file(self, path):
 
@@ -2319,7 +2402,7 @@ class CodeStorageMem(CodeStorage):
         with open(path) as fd:        
         
             # load instructions from json
-            for data in fd: self._put_insn(InsnJson().from_json(data))
+            for data in fd: self.put_insn(InsnJson().from_json(data))
 
     def to_storage(self, other):
 
@@ -2367,8 +2450,8 @@ class CodeStorageMem(CodeStorage):
             prev = insn
 
         # commit instructions changes
-        for ir_addr in deleted: self._del_insn(ir_addr)
-        for insn in updated: self._put_insn(insn)
+        for ir_addr in deleted: self.del_insn(ir_addr)
+        self.put_insn(updated)
 
 
 class TestCodeStorageMem(unittest.TestCase):
@@ -2492,6 +2575,11 @@ class CodeStorageTranslator(CodeStorage):
 
         return self.storage.size()
 
+    @property
+    def version(self):
+
+        return getattr(self.storage, 'version', None)
+
     def get_insn(self, ir_addr):
 
         ir_addr = ir_addr if isinstance(ir_addr, tuple) else (ir_addr, None)
@@ -1,8 +1,16 @@
-import sys, os, struct, random
-import numpy
+import sys, os, struct, random, operator, binascii
 
 from REIL import *
 
+try:
+
+    # optional native executor of IR code
+    import emulator
+
+except ImportError: 
+
+    emulator = None
+
 class MemError(Error):
 
     def __init__(self, addr):
@@ -49,6 +57,13 @@ class CpuInstructionError(CpuError):
         return 'Invalid instruction at %s.%.2d' % (hex(self.addr), self.inum)
 
 
+class CpuDivisionError(CpuError):
+
+    def __str__(self):
+
+        return 'Division by zero at %s.%.2d' % (hex(self.addr), self.inum)
+
+
 class Mem(object):
 
     # start address for memory allocations
@@ -60,51 +75,177 @@ class Mem(object):
     # length to REIL type map
     map_size = { 1: U8, 2: U16, 4: U32, 8: U64 }
 
-    # REIL type to struct format map
-    map_format = { U8: 'B', U16: 'H', U32: 'I', U64: 'Q' }    
+    # REIL type to precompiled struct object map
+    map_struct = { U8: struct.Struct('<B'), U16: struct.Struct('<H'), 
+                   U32: struct.Struct('<I'), U64: struct.Struct('<Q') }
+
+    # memory page size
+    PAGE_SHIFT = 12
+    PAGE_SIZE = 1 << PAGE_SHIFT
+    PAGE_MASK = PAGE_SIZE - 1
 
     def __init__(self, data = None, reader = None, strict = True):
 
-        self.data = {} if data is None else None
+        # page number to ( page data, presence bitmap ) map
+        self.pages = {} if data is None else data
         self.reader, self.strict = reader, strict
         self.alloc_base = self.DEF_ALLOC_BASE
         self.alloc_last = self.alloc_base
 
+    def get_reader(self):
+
+        return self._reader
+
+    def set_reader(self, reader):
+
+        # cache bound method that reads data from external memory reader
+        self._reader = reader
+        self._reader_read = None if reader is None else reader.read
+
+    reader = property(get_reader, set_reader)
+
     def pack(self, size, val):
 
-        return struct.pack(self.map_format[size], val)
+        return self.map_struct[size].pack(val)
 
     def unpack(self, size, val):
 
-        return struct.unpack(self.map_format[size], val)[0] 
+        return self.map_struct[size].unpack(val)[0] 
 
     def clear(self):
 
-        self.data = {}
+        self.pages = {}
+
+    def _chunks(self, addr, size):
+
+        # split memory range into the parts that belongs to separate pages
+        while size > 0:
+
+            num, off = addr >> self.PAGE_SHIFT, addr & self.PAGE_MASK
+            length = min(size, self.PAGE_SIZE - off)
+
+            yield num, off, length
+
+            addr += length
+            size -= length
+
+    def _page(self, num):
+
+        try: 
+
+            return self.pages[num]
+
+        except KeyError:
+
+            # allocate new page filled with zeros
+            page = self.pages[num] = ( bytearray(self.PAGE_SIZE), 
+                                       bytearray(self.PAGE_SIZE >> 3) )
+            return page
+
+    def _bits(self, off, size):
+
+        first, last = off >> 3, (off + size - 1) >> 3
+
+        # masks of bits that belongs to the range in the first and last bytes
+        head, tail = (0xff << (off & 7)) & 0xff, 0xff >> (7 - ((off + size - 1) & 7))
+
+        return first, last, head, tail
+
+    def _is_present(self, bitmap, off, size):
+
+        if size <= 0: return True
+
+        first, last, head, tail = self._bits(off, size)
+
+        if first == last:
+
+            return bitmap[first] & head & tail == head & tail
+
+        # check whole bytes at once
+        return bitmap[first] & head == head and bitmap[last] & tail == tail and \
+               bitmap[first + 1 : last] == b'\xff' * (last - first - 1)
+
+    def _set_present(self, bitmap, off, size):
+
+        if size <= 0: return
+
+        first, last, head, tail = self._bits(off, size)
+
+        if first == last:
+
+            bitmap[first] |= head & tail
+
+        else:
+
+            # set whole bytes at once
+            bitmap[first] |= head
+            bitmap[first + 1 : last] = b'\xff' * (last - first - 1)
+            bitmap[last] |= tail
 
     def _read(self, addr, size):
 
-        data = ''
+        num, off = addr >> self.PAGE_SHIFT, addr & self.PAGE_MASK
 
-        for i in range(0, size):
+        if 0 < size and off + size <= self.PAGE_SIZE:
 
-            if not self.data.has_key(addr + i):
+            # fast path: memory range is located at single page
+            page = self.pages.get(num)
+            if page is None or not self._is_present(page[1], off, size):
 
                 raise MemReadError(addr)
 
-            data += self.data[addr + i]
+            return bytes(page[0][off : off + size])
+
+        data = []
 
-        return data
+        for num, off, length in self._chunks(addr, size):
+
+            page = self.pages.get(num)
+            if page is None or not self._is_present(page[1], off, length):
+
+                raise MemReadError(addr)
+
+            data.append(bytes(page[0][off : off + length]))
+
+        return b''.join(data)
 
     def _write(self, addr, size, data):
 
-        for i in range(0, size):
+        if len(data) < size:
+
+            # slice assignment of shorter data would resize the page
+            raise IndexError('Not enough data to write')
+
+        num, off = addr >> self.PAGE_SHIFT, addr & self.PAGE_MASK
+
+        if 0 < size and off + size <= self.PAGE_SIZE:
+
+            # fast path: memory range is located at single page
+            page = self.pages.get(num)
+            if page is None or not self._is_present(page[1], off, size):
+
+                raise MemWriteError(addr)
+
+            page[0][off : off + size] = data[: size]
+            return
+
+        chunks = []
+
+        for num, off, length in self._chunks(addr, size):
 
-            if not self.data.has_key(addr + i):
+            page = self.pages.get(num)
+            if page is None or not self._is_present(page[1], off, length):
 
                 raise MemWriteError(addr)
 
-            self.data[addr + i] = data[i]
+            chunks.append(( page[0], off, length ))
+
+        ptr = 0
+
+        for page, off, length in chunks:
+
+            page[off : off + length] = data[ptr : ptr + length]
+            ptr += length
 
     def read(self, addr, size):
 
@@ -114,10 +255,10 @@ class Mem(object):
 
         except MemReadError:
 
-            if self.reader is None: raise
+            if self._reader_read is None: raise
 
             # invalid address, try to get the data from external memory reader
-            data = self.reader.read(addr, size)
+            data = self._reader_read(addr, size)
             if data is None: 
 
                 raise
@@ -136,10 +277,10 @@ class Mem(object):
 
             if self.strict:
 
-                if self.reader is None: raise
+                if self._reader_read is None: raise
 
                 # invalid address, check if memory reader knows it
-                if self.reader.read(addr, size) is None: 
+                if self._reader_read(addr, size) is None: 
 
                     raise
 
@@ -157,47 +298,70 @@ class Mem(object):
 
         size = len(data) if size is None and not data is None else size
         addr = self.alloc_addr(size) if addr is None else addr
+        data = b'' if data is None else data[: size]
+        ptr = 0
 
-        for i in range(0, size):
+        for num, off, length in self._chunks(addr, size):
+
+            page, bitmap = self._page(num)
 
             # fill target memory range with specified data (or zeros)
-            byte = '\0' if data is None or i >= len(data) else data[i]
-            self.data[addr + i] = byte
+            chunk = data[ptr : ptr + length]
+            page[off : off + length] = chunk + b'\0' * (length - len(chunk))
+
+            self._set_present(bitmap, off, length)
+            ptr += length
 
         return addr
 
     def store(self, addr, size, val):
 
-        self.write(addr, self.map_length[size], self.pack(size, val))
+        fmt = self.map_struct[size]
+        num, off = addr >> self.PAGE_SHIFT, addr & self.PAGE_MASK
+        page = self.pages.get(num)
+
+        if page is not None and off + fmt.size <= self.PAGE_SIZE and \
+           self._is_present(page[1], off, fmt.size):
+
+            # fast path: value is located at single page, write it directly
+            fmt.pack_into(page[0], off, val)
+
+        else:
+
+            self.write(addr, fmt.size, fmt.pack(val))
 
     def load(self, addr, size):
 
-        val = self.read(addr, self.map_length[size])
+        fmt = self.map_struct[size]
+        num, off = addr >> self.PAGE_SHIFT, addr & self.PAGE_MASK
+        page = self.pages.get(num)
 
-        return self.unpack(size, val)
+        if page is not None and off + fmt.size <= self.PAGE_SIZE and \
+           self._is_present(page[1], off, fmt.size):
 
-    def dump_hex(self, data, width = 16, addr = None):
+            # fast path: value is located at single page, read it directly
+            return fmt.unpack_from(page[0], off)[0]
 
-        def quoted(data):
+        return fmt.unpack(self.read(addr, fmt.size))[0]
 
-            # replace non-alphanumeric characters
-            return ''.join(map(lambda b: b if b.isalnum() else '.', data))
+    # translate table that replaces non-alphanumeric characters
+    DUMP_TABLE = b''.join(map(lambda c: c if c.isalnum() else b'.', map(chr, range(0x100))))
 
-        while data:
+    def dump_hex(self, data, width = 16, addr = None):
+
+        for ptr in range(0, len(data), width):
 
-            line = data[: width]
-            data = data[width :]
+            line = data[ptr : ptr + width]
+            hexed = binascii.hexlify(line)
 
-            s = map(lambda b: '%.2x' % ord(b), line)
+            s = [ hexed[i : i + 2] for i in range(0, len(hexed), 2) ]
             s += [ '  ' ] * (width - len(line))
 
-            s = '%s | %s' % (' '.join(s), quoted(line))
-            if addr is not None: s = '%.8x: %s' % (addr, s)
+            s = '%s | %s' % (' '.join(s), line.translate(self.DUMP_TABLE))
+            if addr is not None: s = '%.8x: %s' % (addr + ptr, s)
 
             print s
 
-            addr += len(line)
-
     def dump(self, addr, size):
 
         # read and dump memory contents
@@ -216,17 +380,103 @@ class TestMem(unittest.TestCase):
         mem.store(0, U16, 0x4444)
         mem.store(0, U8, 0x88)
         
-        assert mem.data == { 0: chr(0x88), 1: chr(0x44), 2: chr(0x22), 3: chr(0x22),
-                             4: chr(0x11), 5: chr(0x11), 6: chr(0x11), 7: chr(0x11) }
+        assert mem.read(0, 8) == '\x88\x44\x22\x22\x11\x11\x11\x11'
         
         assert mem.load(0, U64) == val and \
                mem.load(0, U32) == val & 0xffffffff and \
                mem.load(0, U16) == val & 0xffff and \
                mem.load(0, U8) == val & 0xff
 
+    def test_pages(self):
+
+        mem = Mem(strict = False)
+        addr = Mem.PAGE_SIZE - 2
+
+        # value that crosses page boundary
+        mem.alloc(addr, size = 4)
+        mem.store(addr, U32, 0x11223344)
+
+        assert mem.load(addr, U32) == 0x11223344 and \
+               mem.load(addr + 2, U16) == 0x1122
+
+        try: 
+
+            mem.read(addr + 2, 4)
+            assert False
+
+        except MemReadError as e: 
+
+            # bytes after allocated memory range are not available
+            assert e.addr == addr + 2
+
+    def test_bytearray(self):
+
+        mem = Mem()
+
+        # memory contents can be passed as bytearray as well
+        addr = mem.alloc(data = bytearray(b'\x11\x22'), size = 4)
+
+        assert mem.read(addr, 4) == b'\x11\x22\0\0'
+
+        mem.write(addr, 2, bytearray(b'\x33\x44'))
+
+        assert mem.load(addr, U16) == 0x4433
+
+
+# REIL type to value mask map
+_MASK = { U1: 0x1, U8: 0xff, U16: 0xffff, U32: 0xffffffff, U64: 0xffffffffffffffff }
+
+# REIL type to sign bit map
+_SIGN = { U1: 0x1, U8: 0x80, U16: 0x8000, U32: 0x80000000, U64: 0x8000000000000000 }
+
+def _sx(val, size):
+
+    # sign extend unsigned value of given REIL type
+    return val - ((val & _SIGN[size]) << 1)
+
+def _sdiv(x, y):
+
+    # signed division with rounding towards zero
+    ret = abs(x) // abs(y)
+    return ret if (x < 0) == (y < 0) else -ret
+
+def _smod(x, y):
+
+    # remainder of signed division, has the same sign as dividend
+    return x - y * _sdiv(x, y)
+
+# kinds of arithmetic operations
+_OP_PLAIN  = 0 # result can be used as is
+_OP_MASKED = 1 # unsigned operation, result must be masked
+_OP_SIGNED = 2 # signed operation, operands must be sign extended and result masked
+
+# opcode to ( function, operation kind ) table
+_OPS = [ None ] * len(REIL_INSN)
+
+_OPS[I_STR]  = ( lambda x, y: x,    _OP_PLAIN )
+_OPS[I_ADD]  = ( operator.add,      _OP_MASKED )
+_OPS[I_SUB]  = ( operator.sub,      _OP_MASKED )
+_OPS[I_NEG]  = ( lambda x, y: -x,   _OP_MASKED )
+_OPS[I_MUL]  = ( operator.mul,      _OP_MASKED )
+_OPS[I_DIV]  = ( operator.floordiv, _OP_PLAIN )
+_OPS[I_MOD]  = ( operator.mod,      _OP_PLAIN )
+_OPS[I_SMUL] = ( operator.mul,      _OP_SIGNED )
+_OPS[I_SDIV] = ( _sdiv,             _OP_SIGNED )
+_OPS[I_SMOD] = ( _smod,             _OP_SIGNED )
+_OPS[I_SHL]  = ( operator.lshift,   _OP_MASKED )
+_OPS[I_SHR]  = ( operator.rshift,   _OP_PLAIN )
+_OPS[I_AND]  = ( operator.and_,     _OP_PLAIN )
+_OPS[I_OR]   = ( operator.or_,      _OP_PLAIN )
+_OPS[I_XOR]  = ( operator.xor,      _OP_PLAIN )
+_OPS[I_NOT]  = ( lambda x, y: ~x,   _OP_MASKED )
+_OPS[I_EQ]   = ( operator.eq,       _OP_PLAIN )
+_OPS[I_LT]   = ( operator.lt,       _OP_PLAIN )
+
 
 class Math(object):
 
+    __slots__ = ( 'a', 'b' )
+
     def __init__(self, a = None, b = None):
 
         self.a, self.b = a, b    
@@ -235,77 +485,100 @@ class Math(object):
 
         return None if arg is None else arg.get_val()
 
-    def val_u(self, arg):
+    def eval(self, op, a = None, b = None):
 
-        # Arg to numpy unsigned integer
-        return None if arg is None else {
-            
-             U1: numpy.uint8, 
-             U8: numpy.uint8, 
-            U16: numpy.uint16,
-            U32: numpy.uint32, 
-            U64: numpy.uint64  
+        a = self.a if a is None else a
+        b = self.b if b is None else b
 
-        }[arg.size](self.val(arg))
+        return self.eval_val(op, self.val(a), a.size, 
+                             *(( None, None ) if b is None else ( self.val(b), b.size )))
 
-    def val_s(self, arg):
+    def eval_val(self, op, x, x_size, y = None, y_size = None):
 
-        # Arg to numpy signed integer
-        return None if arg is None else { 
+        # evaluate operation for plain integer values of given size
+        entry = _OPS[op]
+        if entry is None:
 
-             U1: numpy.int8, 
-             U8: numpy.int8, 
-            U16: numpy.int16,
-            U32: numpy.int32, 
-            U64: numpy.int64  
+            raise Error('Opcode %s can\'t be evaluated' % REIL_NAMES_INSN[op])
 
-        }[arg.size](self.val_u(arg))
+        fn, kind = entry
+        size = x_size if y_size is None else max(x_size, y_size)
 
-    def eval(self, op, a = None, b = None):
+        if kind == _OP_PLAIN: 
 
-        a = self.a if a is None else a
-        b = self.b if b is None else b
+            return fn(x, y)
+
+        if kind == _OP_SIGNED: 
+
+            x, y = _sx(x, size), _sx(y, size)
+        
+        return fn(x, y) & _MASK[size]
+
+    def compile(self, op, size):
+
+        entry = _OPS[op]
+        if entry is None:
+
+            raise Error('Opcode %s can\'t be evaluated' % REIL_NAMES_INSN[op])
+
+        fn, kind = entry
+        mask = _MASK[size]
+
+        # get function that evaluates operation for operands of given size
+        if kind == _OP_PLAIN: return fn
+        if kind == _OP_MASKED: return lambda x, y: fn(x, y) & mask
 
-        # evaluale unsigned/unsigned expressions
-        eval_u = lambda fn: fn(self.val_u(a), self.val_u(b)).item()
-        eval_s = lambda fn: fn(self.val_s(a), self.val_s(b)).item()        
-
-        return { 
-
-            I_STR: lambda: a.get_val(),            
-            I_ADD: lambda: eval_u(lambda a, b: a +  b ),
-            I_SUB: lambda: eval_u(lambda a, b: a -  b ),            
-            I_NEG: lambda: eval_u(lambda a, b:     -a ),
-            I_MUL: lambda: eval_u(lambda a, b: a *  b ),
-            I_DIV: lambda: eval_u(lambda a, b: a /  b ),
-            I_MOD: lambda: eval_u(lambda a, b: a %  b ),
-           I_SMUL: lambda: eval_s(lambda a, b: a *  b ),
-           I_SDIV: lambda: eval_s(lambda a, b: a /  b ),
-           I_SMOD: lambda: eval_s(lambda a, b: a %  b ),
-            I_SHL: lambda: eval_u(lambda a, b: a << b ),
-            I_SHR: lambda: eval_u(lambda a, b: a >> b ),
-            I_AND: lambda: eval_u(lambda a, b: a &  b ),
-             I_OR: lambda: eval_u(lambda a, b: a |  b ),
-            I_XOR: lambda: eval_u(lambda a, b: a ^  b ),            
-            I_NOT: lambda: eval_u(lambda a, b:     ~a ),
-             I_EQ: lambda: eval_u(lambda a, b: a == b ),
-             I_LT: lambda: eval_u(lambda a, b: a <  b ) 
-
-        }[op]()
+        return lambda x, y: fn(_sx(x, size), _sx(y, size)) & mask
 
 
 class TestMath(unittest.TestCase):
 
     def test(self):     
 
-        pass
+        u32 = lambda val: Arg(A_CONST, U32, val = val)
+        math = Math()
+
+        # check for correct wraparound of unsigned and signed values
+        assert math.eval(I_ADD, u32(0xffffffff), u32(2)) == 1
+        assert math.eval(I_SUB, u32(0), u32(1)) == 0xffffffff
+        assert math.eval(I_NEG, u32(1)) == 0xffffffff
+        assert math.eval(I_NOT, u32(0)) == 0xffffffff
+        assert math.eval(I_SHL, u32(0x80000001), u32(1)) == 2
+        assert math.eval(I_SMUL, u32(0xffffffff), u32(2)) == 0xfffffffe
+        assert math.eval(I_LT, u32(1), u32(0xffffffff)) == 1
+
+        # signed division must round towards zero
+        assert math.eval(I_SDIV, u32(0xfffffff9), u32(2)) == 0xfffffffd
+        assert math.eval(I_SMOD, u32(0xfffffff9), u32(2)) == 0xffffffff
+
+        # division by zero can't be evaluated
+        self.assertRaises(ZeroDivisionError, math.eval, I_DIV, u32(1), u32(0))
+        self.assertRaises(ZeroDivisionError, math.eval, I_SMOD, u32(1), u32(0))
+
+        # check for evaluation of plain integer values
+        assert math.eval_val(I_ADD, 0xff, U8, 1, U8) == 0
+        assert math.eval_val(I_NEG, 1, U16) == 0xffff
 
 
 class Reg(object):
 
-    def __init__(self, name, val, is_temp = False):
+    __slots__ = ( 'name', 'is_temp', 'vals', 'index' )
+
+    def __init__(self, name, vals, index, is_temp = False):
 
-        self.name, self.val, self.is_temp = name, val, is_temp
+        # register value is located at given index of the values list
+        self.name, self.is_temp = name, is_temp
+        self.vals, self.index = vals, index
+
+    def get_val(self):
+
+        return self.vals[self.index]
+
+    def set_val(self, val):
+
+        self.vals[self.index] = val
+
+    val = property(get_val, set_val)
 
 
 class Cpu(object):
@@ -317,8 +590,29 @@ class Cpu(object):
         self.mem = Mem() if mem is None else mem
         self.math = Math() if math is None else math
         self.arch = get_arch(arch)
+
+        # register name to Reg instance maps and lists of register values,
+        # indexes of registers in these lists never change
+        self.regs, self.temp_regs = {}, {}
+        self.reg_vals, self.temp_vals = [], []
         self.reset()
 
+        # opcode-specific instruction handlers and flags of a, b and c
+        # operands which values are needed by the handler
+        self.handlers = dict(map(lambda op: ( op, ( self.insn_other, True, True, False ) ), 
+                                 REIL_INSN))
+        self.handlers.update({
+
+            I_NONE: ( self.insn_none,  False, False, False ),
+             I_UNK: ( self.insn_unk,   False, False, False ),
+             I_JCC: ( self.insn_jcc,   True,  False, True  ),
+             I_STM: ( self.insn_stm,   True,  False, True  ),
+             I_LDM: ( self.insn_ldm,   True,  False, False ),
+             I_STR: ( self.insn_other, True,  False, False ),
+             I_NEG: ( self.insn_other, True,  False, False ),
+             I_NOT: ( self.insn_other, True,  False, False )
+        })
+
     def set_storage(self, storage = None):
 
         self.mem.reader = None if storage is None else storage.reader
@@ -330,7 +624,14 @@ class Cpu(object):
             # set up caller specified registers set
             for name, val in regs.items(): self.reg(name, val = val)
 
-        else: self.regs = {}
+        else: 
+
+            # forget all registers
+            self.regs, self.temp_regs = {}, {}
+            self.reg_vals, self.temp_vals = [], []
+
+        # compiled code refers to register indexes
+        self.clear_code_cache()
 
         if mem is not None:
 
@@ -338,11 +639,9 @@ class Cpu(object):
 
     def reset_temp(self):
 
-        for name, reg in self.regs.items():
-
-            if reg.is_temp: self.regs.pop(name)
+        self.temp_vals[:] = [ self.DEF_REG_VAL ] * len(self.temp_vals)
 
-    def reg(self, name, val = DEF_REG_VAL, is_temp = False):
+    def reg_name(self, name, is_temp = False):
 
         name = name.upper()
         if not name[:2] in [ 'R_', 'V_' ]:
@@ -350,90 +649,111 @@ class Cpu(object):
             # make canonical register name
             name = '%s_%s' % ( 'V' if is_temp else 'R', name )
 
-        if not self.regs.has_key(name): 
+        return name
+
+    def reg(self, name, val = DEF_REG_VAL, is_temp = False):
 
-            reg = self.regs[name] = Reg(name, val, is_temp = is_temp)
+        name = self.reg_name(name, is_temp = is_temp)
 
-        else: 
+        # temp registers are stored separately from the main ones
+        regs, vals = ( self.temp_regs, self.temp_vals ) if is_temp else \
+                     ( self.regs, self.reg_vals )
 
-            reg = self.regs[name]
+        try:
+
+            reg = regs[name]
+
+        except KeyError:
+
+            # assign index for the new register
+            reg = regs[name] = Reg(name, vals, len(vals), is_temp = is_temp)
+            vals.append(val)
 
         return reg
 
-    def arg(self, arg):
+    def reg_index(self, name, is_temp = False):
 
-        if arg.type == A_REG: 
+        return self.reg(name, is_temp = is_temp).index
 
-            return Arg(A_CONST, arg.size, val = self.reg(arg.name).val)
-        
-        if arg.type == A_TEMP: 
+    def arg(self, arg):
+
+        # get ( value, size ) pair of the argument
+        if arg.type == A_REG or arg.type == A_TEMP: 
 
-            return Arg(A_CONST, arg.size, val = self.reg(arg.name, is_temp = True).val)
+            reg = self.reg(arg.name, is_temp = arg.type == A_TEMP)
+            return reg.val & _MASK[arg.size], arg.size
 
         if arg.type == A_CONST: 
 
-            return arg
+            return arg.get_val(), arg.size
 
         if arg.type == A_NONE: 
 
-            return None
+            return None, None
 
     def evaluate(self, op, size, a, b):
 
-        return Arg(A_CONST, size, val = self.math.eval(op, a, b))
+        return self.math.eval_val(op, a[0], a[1], b[0], b[1]) & _MASK[size]
 
     def insn_none(self, insn, a, b, c):
 
         return None
 
+    def insn_unk(self, insn, a, b, c):
+
+        # instruction that can't be emulated
+        raise CpuInstructionError(insn.addr, insn.inum)
+
     def insn_jcc(self, insn, a, b, c):
 
         # return address of the next instruction to execute if condition was taken
-        return c.get_val() if a.get_val() != 0 else None
+        return c[0] if a[0] != 0 else None
 
     def insn_stm(self, insn, a, b, c):
 
         # store a to memory
-        self.mem.store(c.get_val(), insn.a.size, a.get_val())
+        self.mem.store(c[0], insn.a.size, a[0])
         return None
 
     def insn_ldm(self, insn, a, b, c):
 
         # read from memory to c
-        self.reg(insn.c.name).val = self.mem.load(a.get_val(), insn.c.size)
+        reg = self.reg(insn.c.name, is_temp = insn.c.type == A_TEMP)
+        reg.val = self.mem.load(a[0], insn.c.size)
         return None
 
     def insn_other(self, insn, a, b, c):
 
         # evaluate all other instructions
-        self.reg(insn.c.name).val = self.evaluate(insn.op, insn.c.size, a, b).get_val()        
+        reg = self.reg(insn.c.name, is_temp = insn.c.type == A_TEMP)
+
+        try: 
+
+            reg.val = self.evaluate(insn.op, insn.c.size, a, b)
+
+        except ZeroDivisionError:
+
+            raise CpuDivisionError(insn.addr, insn.inum)
+
         return None
 
     def execute(self, insn):
 
-        # get arguments values
-        a, b, c = self.arg(insn.a), self.arg(insn.b), self.arg(insn.c)
-        
-        if not insn.op in REIL_INSN:
+        handler = self.handlers.get(insn.op)
+        if handler is None:
 
-            # invalid opcode
+            # instruction was constructed with invalid opcode
             raise CpuInstructionError(insn.addr, insn.inum)
 
-        try:
-            
-            return {
-
-                I_NONE: self.insn_none,
-                 I_JCC: self.insn_jcc,
-                 I_STM: self.insn_stm,
-                 I_LDM: self.insn_ldm
+        handler, need_a, need_b, need_c = handler
 
-            # call opcode-specific handler
-            }[insn.op](insn, a, b, c)
+        # get values of the arguments that handler needs
+        a = self.arg(insn.a) if need_a else ( None, None )
+        b = self.arg(insn.b) if need_b else ( None, None )
+        c = self.arg(insn.c) if need_c else ( None, None )
 
-        except KeyError:
-
-            return self.insn_other(insn, a, b, c)
+        # call opcode-specific handler
+        return handler(insn, a, b, c)
 
     def get_ip(self):
 
@@ -443,35 +763,209 @@ class Cpu(object):
 
         self.reg(self.arch.Registers.ip).val = val
 
-    def run(self, storage, addr = 0L):
+    def clear_code_cache(self):
 
-        next = addr
+        # compiled IR code of machine instructions
+        self.code_cache, self.code_storage, self.code_version = {}, None, None
 
-        # use specified storage instance
-        self.set_storage(storage)        
-        self.set_ip(next)
+    def _arg_getter(self, arg):
+
+        if arg.type == A_CONST:
+
+            val = arg.get_val()
+            return lambda: val
+
+        if arg.type == A_NONE:
+
+            return lambda: None
+
+        reg = self.reg(arg.name, is_temp = arg.type == A_TEMP)
+        vals, index, mask = reg.vals, reg.index, _MASK[arg.size]
+
+        return lambda: vals[index] & mask
+
+    def _arg_setter(self, arg):
+
+        reg = self.reg(arg.name, is_temp = arg.type == A_TEMP)
+        vals, index = reg.vals, reg.index
+
+        def set_val(val): vals[index] = val
+
+        return set_val
+
+    def compile_insn(self, insn):
+
+        #
+        # Convert IR instruction into the function that executes it and
+        # returns address of the next instruction if JCC was taken. 
+        # All of the arguments information is resolved here only once.
+        #
+        op = insn.op
+        get_a, get_b = self._arg_getter(insn.a), self._arg_getter(insn.b)
+
+        if op == I_NONE:
+
+            return lambda: None
+
+        elif op == I_UNK or not op in REIL_INSN:
+
+            def fn(): raise CpuInstructionError(insn.addr, insn.inum)
+
+        elif op == I_JCC:
+
+            get_c = self._arg_getter(insn.c)
+            fn = lambda: get_c() if get_a() != 0 else None
+
+        elif op == I_STM:
+
+            get_c, size = self._arg_getter(insn.c), insn.a.size
+
+            def fn(): self.mem.store(get_c(), size, get_a())
+
+        elif op == I_LDM:
+
+            set_c, size = self._arg_setter(insn.c), insn.c.size
+
+            def fn(): set_c(self.mem.load(get_a(), size))
+
+        else:
+
+            size = insn.a.size if insn.b.type == A_NONE else max(insn.a.size, insn.b.size)
+            calc, mask = self.math.compile(op, size), _MASK[insn.c.size]
+            set_c = self._arg_setter(insn.c)
+
+            if insn.b.type == A_NONE:
+
+                # unary operation, don't fetch b
+                def fn(): set_c(calc(get_a(), None) & mask)
+
+            elif op in [ I_DIV, I_MOD, I_SDIV, I_SMOD ]:
+
+                def fn(): 
+
+                    try: set_c(calc(get_a(), get_b()) & mask)
+                    except ZeroDivisionError: raise CpuDivisionError(insn.addr, insn.inum)
+
+            else:
+
+                def fn(): set_c(calc(get_a(), get_b()) & mask)
+
+        return fn
+
+    def get_code(self, storage, addr):
+
+        version = getattr(storage, 'version', None)
+
+        if storage is not self.code_storage or version != self.code_version:
+
+            # code storage or it's contents was changed
+            self.clear_code_cache()
+            self.code_storage, self.code_version = storage, version
+
+        try:
+
+            return self.code_cache[addr]
+
+        except KeyError:
 
-        while True:
-            
             try:
 
                 # query list of IR instructions from storage                
-                insn_list = storage.get_insn(next)
+                insn_list = storage.get_insn(addr)
 
             except StorageError:
 
-                raise CpuReadError(next)
+                raise CpuReadError(addr)
+
+            code = self.compile_code(insn_list)
+
+            # cache compiled code only if storage can tell when it was changed
+            if version is not None: self.code_cache[addr] = code
+
+            return code
+
+    def compile_code(self, insn_list):
+
+        #
+        # Convert IR code of machine instruction into the function that
+        # executes it and returns address of the next instruction.
+        #
+        ip = self.reg(self.arch.Registers.ip)
+        vals, index, addr = ip.vals, ip.index, insn_list[0].addr
+
+        if emulator is not None and type(self.mem) is Mem and type(self.math) is Math:
+
+            # last instruction of the function or unconditional jump has no next
+            next = insn_list[-1].next()
+            next = None if next is None else next[0]
+
+            try:
+
+                code = emulator.Code(insn_list, self.reg_index, Mem.PAGE_SHIFT)
+
+            except NotImplementedError:
 
-            for insn in insn_list:
+                # instruction stream contains unsupported operations
+                code = None
+
+            if code is not None:
+
+                def block():
+
+                    # instruction pointer must be valid if native code fails
+                    vals[index] = addr
+
+                    try:
+
+                        ret = code.run(self)
+
+                    except ZeroDivisionError:
+
+                        insn = insn_list[code.pos]
+                        raise CpuDivisionError(insn.addr, insn.inum)
+
+                    # check if JCC was taken
+                    if ret is not None: return ret
+
+                    vals[index] = next
+                    return next
+
+                return block
+
+        # addresses of the next machine instruction are known in advance
+        code = [ ( self.compile_insn(insn), insn.next() ) for insn in insn_list ]
+        code = [ ( fn, None if next is None else next[0] ) for fn, next in code ]
+
+        def block():
+
+            vals[index] = addr
+
+            for fn, next_addr in code:
 
                 # execute single instruction
-                next = self.execute(insn)
+                next = fn()
 
                 # check if JCC was taken
                 if next is not None: break
-                else: next, _ = insn.next()
+                
+                next = vals[index] = next_addr
+
+            return next
+
+        return block
+
+    def run(self, storage, addr = 0L):
+
+        next = addr
+
+        # use specified storage instance
+        self.set_storage(storage)        
+        self.set_ip(next)
 
-                self.set_ip(next)
+        while True:
+            
+            # execute machine instruction
+            next = self.get_code(storage, next)()
 
             # remove temp registers
             self.reset_temp()
@@ -499,11 +993,9 @@ class Cpu(object):
         if show_temp:
 
             # dump temp registers
-            for reg in self.regs.values():
-
-                if reg.is_temp:
+            for reg in self.temp_regs.values():
 
-                    print '%8s: %.16x' % (reg.name, reg.val)
+                print '%8s: %.16x' % (reg.name, reg.val)
 
     def dump_mem(self, addr, size): 
 
@@ -572,12 +1064,268 @@ class TestCpu(unittest.TestCase):
         # check for correct return value
         assert cpu.reg('eax').val == 0x90909090
 
+    def storage(self, code, storage = None):
+
+        storage = CodeStorageMem(self.arch) if storage is None else storage
+
+        # put IR code of machine instructions into the storage
+        for addr, insn_list in enumerate(code):
+
+            for inum, ( op, a, b, c ) in enumerate(insn_list):
+
+                insn = Insn(op = op, size = 1, ir_addr = ( addr, inum ), a = a, b = b, c = c)
+                if inum == len(insn_list) - 1: insn.set_flag(IOPT_ASM_END)
+
+                storage.put_insn(insn)
+
+        return storage
+
+    def test_division(self):
+
+        reg = lambda name: Arg(A_REG, U32, name)
+
+        # division by zero must be reported as cpu error
+        for op in [ I_DIV, I_MOD, I_SDIV, I_SMOD ]:
+
+            storage = self.storage([[ ( I_STR, Arg(A_CONST, U32, val = 1), Arg(), reg('R_EAX') ),
+                                      ( op, reg('R_EAX'), reg('R_ECX'), reg('R_EDX') ) ]])
+            cpu = Cpu(self.arch)
+
+            try: 
+
+                cpu.run(storage, 0)
+                assert False
+
+            except CpuDivisionError as e: 
+
+                assert e.addr == 0 and e.inum == 1
+
+    def test_code_cache(self):
+
+        reg = lambda name: Arg(A_REG, U32, name)
+        const = lambda val: Arg(A_CONST, U32, val = val)
+
+        class _Storage(CodeStorageMem):
+
+            # storage backend that doesn't care about version
+            def _put_insn(self, insn): 
+
+                self.items[( Insn_addr(insn), Insn_inum(insn) )] = insn
+
+        class _StorageNoVersion(object):
+
+            # storage that doesn't track changes of it's contents
+            reader = None
+
+            def __init__(self, arch): self.storage = CodeStorageMem(arch)
+            def get_insn(self, ir_addr): return self.storage.get_insn(ir_addr)
+            def put_insn(self, insn): self.storage.put_insn(insn)
+
+        for storage in [ CodeStorageMem(self.arch), _Storage(self.arch), 
+                         _StorageNoVersion(self.arch) ]:
+
+            storage = self.storage([[ ( I_STR, const(1), Arg(), reg('R_EAX') ),
+                                      ( I_JCC, const(1), Arg(), const(0x100) ) ]], 
+                                   storage = storage)
+            cpu = Cpu(self.arch)
+
+            try: cpu.run(storage, 0)
+            except CpuReadError as e: assert e.addr == 0x100
+
+            assert cpu.reg('eax').val == 1
+
+            # modify already executed code
+            storage.put_insn(Insn(op = I_STR, size = 1, ir_addr = ( 0, 0 ), 
+                                  a = const(2), b = Arg(), c = reg('R_EAX')))
+
+            try: cpu.run(storage, 0)
+            except CpuReadError as e: assert e.addr == 0x100
+
+            assert cpu.reg('eax').val == 2
+
+        # reset must forget all registers
+        cpu.reset()
+
+        assert len(cpu.regs) == 0
+
+    def test_execute(self):
+
+        reg = lambda name, size = U32: Arg(A_REG, size, name)
+        const = lambda val, size = U32: Arg(A_CONST, size, val = val)
+
+        cpu = Cpu(self.arch)
+        cpu.reg('eax').val = 0x1ff
+
+        # arguments are passed as ( value, size ) pairs
+        assert cpu.arg(reg('R_EAX', U8)) == ( 0xff, U8 )
+        assert cpu.arg(const(0x12345, U16)) == ( 0x2345, U16 )
+        assert cpu.arg(Arg()) == ( None, None )
+
+        assert cpu.evaluate(I_ADD, U8, ( 0xff, U8 ), ( 2, U8 )) == 1
+
+        # execute single IR instruction
+        insn = Insn(op = I_ADD, size = 1, ir_addr = ( 0, 0 ), 
+                    a = reg('R_EAX'), b = const(1), c = reg('R_ECX'))
+
+        assert cpu.execute(insn) is None
+        assert cpu.reg('ecx').val == 0x200
+
+    def test_invalid_opcode(self):
+
+        cpu = Cpu(self.arch)
+
+        # instruction constructor doesn't validate opcode
+        insn = Insn(op = len(REIL_INSN), size = 1, ir_addr = ( 1, 2 ), 
+                    a = Arg(A_CONST, U32, val = 1), c = Arg(A_REG, U32, 'R_EAX'))
+
+        insn.set_flag(IOPT_ASM_END)
+
+        for fn in [ lambda: cpu.execute(insn), 
+                    lambda: cpu.compile_insn(insn)(),
+                    lambda: cpu.compile_code([ insn ])() ]:
+
+            try: 
+
+                fn()
+                assert False
+
+            except CpuInstructionError as e: 
+
+                assert ( e.addr, e.inum ) == ( 1, 2 )
+
+    def test_execute_operands(self):
+
+        reg = lambda name, size = U32: Arg(A_REG, size, name)
+        const = lambda val, size = U32: Arg(A_CONST, size, val = val)
+
+        # fetching of this argument value fails
+        invalid = Arg(A_REG, U32)
+
+        fetched = []
+
+        class _Cpu(Cpu):
+
+            def arg(self, arg):
+
+                fetched.append(arg)
+                return Cpu.arg(self, arg)
+
+        cpu = _Cpu(self.arch)
+        addr = cpu.mem.alloc(size = 4)
+
+        for op, a, c, need_c in [ ( I_STR, const(1),    reg('R_EAX'), False ),
+                                  ( I_NEG, const(1),    reg('R_EAX'), False ),
+                                  ( I_NOT, const(1),    reg('R_EAX'), False ),
+                                  ( I_JCC, const(1),    const(2),     True  ),
+                                  ( I_STM, const(1),    const(addr),  True  ),
+                                  ( I_LDM, const(addr), reg('R_EAX'), False ) ]:
+
+            insn = Insn(op = op, size = 1, ir_addr = ( 0, 0 ), a = a, b = invalid, c = c)
+            del fetched[:]
+
+            cpu.execute(insn)
+
+            # check that handler got only operands that it needs
+            assert fetched[0] is a and not invalid in fetched
+            assert ( c in fetched ) == need_c
+
+    @unittest.skipIf(emulator is None, 'native executor is not available')
+    def test_emulator(self):
+
+        reg = lambda name, size = U32: Arg(A_REG, size, name)
+        tmp = lambda name, size = U32: Arg(A_TEMP, size, name)
+        const = lambda val, size = U32: Arg(A_CONST, size, val = val)
+
+        addr = Mem.DEF_ALLOC_BASE + Mem.PAGE_SIZE - 6
+
+        code = [ 
+
+            [ ( I_STR, const(10), Arg(), reg('R_ECX') ),
+              ( I_STR, const(0x80000001), Arg(), reg('R_EAX') ),
+              ( I_STR, const(addr), Arg(), reg('R_EBX') ) ],
+
+            # loop body with all of the supported operations
+            [ ( I_MUL,  reg('R_EAX'), reg('R_ECX'), tmp('V_00') ),
+              ( I_ADD,  tmp('V_00'), const(0x12345678), tmp('V_01') ),
+              ( I_XOR,  tmp('V_01'), reg('R_EBX'), tmp('V_02') ),
+              ( I_SHL,  tmp('V_02'), const(3, U8), tmp('V_03') ),
+              ( I_SHR,  tmp('V_02'), const(29, U8), tmp('V_04') ),
+              ( I_OR,   tmp('V_03'), tmp('V_04'), reg('R_EAX') ),
+              ( I_STM,  reg('R_EAX'), Arg(), reg('R_EBX') ),
+              ( I_LDM,  reg('R_EBX'), Arg(), tmp('V_05', U16) ),
+              ( I_STR,  tmp('V_05', U16), Arg(), reg('R_EDX') ),
+              ( I_NOT,  reg('R_EDX'), Arg(), tmp('V_06') ),
+              ( I_NEG,  tmp('V_06'), Arg(), tmp('V_07') ),
+              ( I_SMUL, tmp('V_07'), const(0xfffffffd), tmp('V_08') ),
+              ( I_SDIV, tmp('V_08'), const(0xfffffff9), tmp('V_09') ),
+              ( I_SMOD, tmp('V_08'), const(7), tmp('V_0a') ),
+              ( I_DIV,  reg('R_EAX'), const(7), tmp('V_0b') ),
+              ( I_MOD,  reg('R_EAX'), const(7), tmp('V_0c') ),
+              ( I_SUB,  tmp('V_09'), tmp('V_0a'), reg('R_ESI') ),
+              ( I_AND,  tmp('V_0b'), tmp('V_0c'), reg('R_EDI') ),
+              ( I_ADD,  reg('R_EBX'), const(1), reg('R_EBX') ),
+              ( I_LT,   reg('R_ESI'), reg('R_EDI'), reg('R_CF', U1) ),
+              ( I_EQ,   reg('R_CF', U1), const(1, U1), reg('R_ZF', U1) ) ],
+
+            # decrement counter and jump to the loop body
+            [ ( I_SUB, reg('R_ECX'), const(1), reg('R_ECX') ),
+              ( I_EQ,  reg('R_ECX'), const(0), tmp('V_00', U1) ),
+              ( I_NOT, tmp('V_00', U1), Arg(), tmp('V_01', U1) ),
+              ( I_JCC, tmp('V_01', U1), Arg(), const(1) ) ],
+
+            # jump to invalid address
+            [ ( I_JCC, const(1, U1), Arg(), const(0x100) ) ] ]
+
+        # code that fails in the middle or at the beginning of machine instruction
+        faults = [ [ [ ( I_JCC, const(1, U1), Arg(), const(1) ) ],
+                     [ ( I_STR, const(1), Arg(), reg('R_EAX') ),
+                       ( I_LDM, const(0x1000), Arg(), reg('R_EDX') ) ] ],
+
+                   [ [ ( I_JCC, const(1, U1), Arg(), const(1) ) ],
+                     [ ( I_LDM, const(0x1000), Arg(), reg('R_EDX') ) ] ] ]
+
+        def _run(code, error):
+
+            cpu = Cpu(self.arch)
+            cpu.mem.alloc(Mem.DEF_ALLOC_BASE, size = Mem.PAGE_SIZE * 2)
+
+            try: cpu.run(self.storage(code), 0)
+            except error: pass
+
+            return dict(map(lambda reg: ( reg.name, reg.val ), cpu.regs.values())), \
+                   cpu.mem.read(addr, 16), cpu.get_ip()
+
+        def _run_all():
+
+            return [ _run(code, CpuReadError) ] + \
+                   [ _run(fault, MemReadError) for fault in faults ]
+
+        global emulator
+        native = _run_all()
+
+        # instruction pointer must point to the jump or to the failed instruction
+        assert [ ip for regs, data, ip in native ] == [ 3, 1, 1 ]
+
+        try: 
+
+            # run the same code using Python implementation
+            emulator, module = None, emulator
+            assert native == _run_all()
+
+        finally:
+
+            emulator = module
+
 
 class Stack(object):
 
     # start address of stack memory
     DEF_STACK_BASE = 0x12000000
 
+    # ( item size, items count ) to precompiled struct object map for push_many(),
+    # it's shared between instances because Abi creates new stack for each call
+    _formats = {}
+
     def __init__(self, mem, item_size, addr = None, size = None):
 
         self.size = 0x1000 if size is None else size
@@ -591,6 +1339,25 @@ class Stack(object):
         self.top -= self.item_size
         self.mem.store(self.top, Mem.map_size[self.item_size], val)
 
+    def push_many(self, vals):
+
+        # the same as push() for each value, but writes memory only once
+        vals = list(vals)
+        vals.reverse()
+
+        try:
+
+            fmt = self._formats[( self.item_size, len(vals) )]
+
+        except KeyError:
+
+            item = Mem.map_struct[Mem.map_size[self.item_size]].format[1 :]
+            fmt = self._formats[( self.item_size, len(vals) )] = \
+                  struct.Struct('<' + item * len(vals))
+
+        self.top -= fmt.size
+        self.mem.write(self.top, fmt.size, fmt.pack(*vals))
+
     def pop(self):
 
         val = self.mem.load(self.top, Mem.map_size[self.item_size])
@@ -638,6 +1405,31 @@ class TestStack(unittest.TestCase):
         # check for correct return value
         cpu.reg('eax').val == arg
 
+    def test_push_many(self):
+
+        stack = Stack(Mem(), 4)
+
+        # pushed values must be popped in reverse order
+        stack.push_many([ 1, 2, 3 ])
+        stack.push(4)
+
+        assert [ stack.pop() for i in range(4) ] == [ 4, 3, 2, 1 ]
+        assert stack.top == stack.bottom
+
+    def test_push_many_formats(self):
+
+        abi = Abi(Cpu(self.arch), None)
+        Stack._formats.pop(( 4, 2 ), None)
+
+        abi.pushargs([ 1, 2 ])
+        fmt = Stack._formats[( 4, 2 )]
+
+        # next call with the same arguments count must use cached struct object
+        stack = abi.pushargs([ 3, 4 ])
+
+        assert Stack._formats[( 4, 2 )] is fmt
+        assert [ stack.pop() for i in range(2) ] == [ 3, 4 ]
+
 
 class Abi(object):
 
@@ -661,7 +1453,7 @@ class Abi(object):
 
     def buff(self, data, addr = None, fill = None):
 
-        if isinstance(data, basestring):
+        if isinstance(data, ( basestring, bytearray )):
 
             # data was passed 
             size = len(data)
@@ -677,7 +1469,7 @@ class Abi(object):
     def string(self, data):
 
         # allocate null terminated buffer
-        return self.buff(data + '\0\0\0\0')
+        return self.buff(data + b'\0\0\0\0')
 
     def stack(self, size = None):
 
@@ -688,13 +1480,12 @@ class Abi(object):
         args = list(args)
         args.reverse()
 
+        # copy buffers into the memory
+        args = map(lambda a: self.string(a) if isinstance(a, ( basestring, bytearray )) else a, args)
+
         # push arguments into the stack
         stack = self.stack()        
-        for a in args: 
-
-            # copy buffers into the memory
-            a = self.string(a) if isinstance(a, basestring) else a
-            stack.push(a)
+        stack.push_many(args)
 
         return stack
 
@@ -0,0 +1,315 @@
+# cython: cdivision=True
+
+cimport libopenreil
+
+from libc.stdlib cimport malloc, calloc, free
+from libc.string cimport memset
+
+ctypedef unsigned long long uint64_t
+ctypedef long long int64_t
+
+cdef struct arg_t:
+
+    libopenreil._reil_type_t type
+    int index           # register or temp register slot
+    uint64_t val        # constant value
+    uint64_t mask       # argument value mask
+
+cdef struct insn_t:
+
+    libopenreil._reil_op_t op
+    int size            # operands size (see REIL_SIZE)
+    int length          # memory access length for I_STM and I_LDM
+    uint64_t mask       # result mask
+    arg_t a, b, c
+
+cdef uint64_t MASK[5]
+cdef uint64_t SIGN[5]
+cdef int LENGTH[5]
+
+MASK[:] = [ 0x1, 0xff, 0xffff, 0xffffffff, 0xffffffffffffffff ]
+SIGN[:] = [ 0x1, 0x80, 0x8000, 0x80000000, 0x8000000000000000 ]
+LENGTH[:] = [ 0, 1, 2, 4, 8 ]
+
+cdef inline int64_t sx(uint64_t val, int size):
+
+    # sign extend value of given REIL type
+    if val & SIGN[size]: return <int64_t>(val | ~MASK[size])
+    return <int64_t>val
+
+
+cdef class Code:
+
+    #
+    # IR code of single machine instruction compiled into the array of
+    # C structures. Register values are copied from the Cpu values list
+    # before the execution and copied back when it's done, temp registers 
+    # exists only while the code is running.
+    #
+    cdef insn_t* insns
+    cdef int insns_count, page_shift
+    cdef uint64_t* regs
+    cdef uint64_t* temps
+    cdef char* written
+    cdef int* reg_index
+    cdef int regs_count, temps_count
+
+    # index of the instruction that is executing
+    cdef readonly int pos
+
+    def __cinit__(self):
+
+        self.insns = NULL
+        self.regs = self.temps = NULL
+        self.written = NULL
+        self.reg_index = NULL
+
+    def __init__(self, insn_list, reg_index, page_shift):
+
+        reg_slots, temp_slots = {}, {}
+
+        self.page_shift = page_shift
+        self.insns_count = len(insn_list)
+        self.insns = <insn_t*>calloc(self.insns_count, sizeof(insn_t))
+        if self.insns == NULL: raise MemoryError()
+
+        for i, insn in enumerate(insn_list):
+
+            if insn.op == libopenreil.I_UNK or insn.op > libopenreil.I_LT:
+
+                # let the caller to handle this instruction
+                raise NotImplementedError('Opcode %d is not supported' % insn.op)
+
+            self.insns[i].op = insn.op
+
+            self.set_arg(&self.insns[i].a, insn.a, reg_slots, temp_slots)
+            self.set_arg(&self.insns[i].b, insn.b, reg_slots, temp_slots)
+            self.set_arg(&self.insns[i].c, insn.c, reg_slots, temp_slots)
+
+            if insn.op == libopenreil.I_STM:
+
+                self.insns[i].length = LENGTH[insn.a.size]
+
+            elif insn.op == libopenreil.I_LDM:
+
+                self.insns[i].length = LENGTH[insn.c.size]
+
+            elif insn.op not in [ libopenreil.I_NONE, libopenreil.I_JCC ]:
+
+                size = insn.a.size if insn.b.type == libopenreil.A_NONE else \
+                       max(insn.a.size, insn.b.size)
+
+                self.insns[i].size = size
+                self.insns[i].mask = MASK[size] & MASK[insn.c.size]
+
+        self.regs_count, self.temps_count = len(reg_slots), len(temp_slots)
+        self.regs = <uint64_t*>malloc((self.regs_count + 1) * sizeof(uint64_t))
+        self.temps = <uint64_t*>malloc((self.temps_count + 1) * sizeof(uint64_t))
+        self.written = <char*>malloc(self.regs_count + 1)
+        self.reg_index = <int*>malloc((self.regs_count + 1) * sizeof(int))
+
+        if self.regs == NULL or self.temps == NULL or self.written == NULL or \
+           self.reg_index == NULL:
+
+            raise MemoryError()
+
+        # get indexes of the registers in Cpu values list
+        for name, i in reg_slots.items(): self.reg_index[i] = reg_index(name)
+
+    def __dealloc__(self):
+
+        free(self.insns)
+        free(self.regs)
+        free(self.temps)
+        free(self.written)
+        free(self.reg_index)
+
+    cdef set_arg(self, arg_t* arg, src, dict reg_slots, dict temp_slots):
+
+        arg.type = src.type
+
+        if src.type == libopenreil.A_NONE: return
+
+        arg.mask = MASK[src.size]
+
+        if src.type == libopenreil.A_CONST:
+
+            arg.val = src.get_val()
+
+        else:
+
+            # assign slot number for register
+            slots = temp_slots if src.type == libopenreil.A_TEMP else reg_slots
+            arg.index = slots.setdefault(src.name, len(slots))
+
+    cdef inline uint64_t get(self, arg_t* arg):
+
+        if arg.type == libopenreil.A_CONST: return arg.val
+        if arg.type == libopenreil.A_REG: return self.regs[arg.index] & arg.mask
+        if arg.type == libopenreil.A_TEMP: return self.temps[arg.index] & arg.mask
+
+        return 0
+
+    cdef inline set(self, arg_t* arg, uint64_t val):
+
+        if arg.type == libopenreil.A_REG:
+
+            self.regs[arg.index] = val
+            self.written[arg.index] = 1
+
+        elif arg.type == libopenreil.A_TEMP:
+
+            self.temps[arg.index] = val
+
+    cdef object load(self, mem, uint64_t addr, int length):
+
+        cdef uint64_t off = addr & ((1 << self.page_shift) - 1), val = 0
+        cdef unsigned char* data
+        cdef unsigned char* bitmap
+        cdef int i
+
+        if off + length <= (1 << self.page_shift):
+
+            page = mem.pages.get(addr >> self.page_shift)
+            if page is not None:
+
+                data, bitmap = <bytearray>page[0], <bytearray>page[1]
+
+                for i in range(length):
+
+                    if not bitmap[(off + i) >> 3] & (1 << ((off + i) & 7)): break
+
+                else:
+
+                    # fast path: read value directly from the page
+                    for i in range(length): val |= (<uint64_t>data[off + i]) << (i * 8)
+                    return val
+
+        return mem.load(addr, mem.map_size[length])
+
+    cdef object store(self, mem, uint64_t addr, int length, uint64_t val):
+
+        cdef uint64_t off = addr & ((1 << self.page_shift) - 1)
+        cdef unsigned char* data
+        cdef unsigned char* bitmap
+        cdef int i
+
+        if off + length <= (1 << self.page_shift):
+
+            page = mem.pages.get(addr >> self.page_shift)
+            if page is not None:
+
+                data, bitmap = <bytearray>page[0], <bytearray>page[1]
+
+                for i in range(length):
+
+                    if not bitmap[(off + i) >> 3] & (1 << ((off + i) & 7)): break
+
+                else:
+
+                    # fast path: write value directly into the page
+                    for i in range(length): data[off + i] = (val >> (i * 8)) & 0xff
+                    return
+
+        mem.store(addr, mem.map_size[length], val)
+
+    cdef object execute(self, mem):
+
+        cdef insn_t* insn
+        cdef uint64_t x, y, ret
+        cdef int64_t sx_x, sx_y, sret
+        cdef int i, op
+
+        for i in range(self.insns_count):
+
+            insn = &self.insns[i]
+            op, self.pos = insn.op, i
+
+            if op == libopenreil.I_NONE: continue
+
+            x, y = self.get(&insn.a), self.get(&insn.b)
+
+            if op == libopenreil.I_JCC:
+
+                # return address of the next instruction if condition was taken
+                if x != 0: return self.get(&insn.c)
+                continue
+
+            elif op == libopenreil.I_STM:
+
+                self.store(mem, self.get(&insn.c), insn.length, x)
+                continue
+
+            elif op == libopenreil.I_LDM:
+
+                self.set(&insn.c, self.load(mem, x, insn.length))
+                continue
+
+            elif op == libopenreil.I_STR: ret = x
+            elif op == libopenreil.I_ADD: ret = x + y
+            elif op == libopenreil.I_SUB: ret = x - y
+            elif op == libopenreil.I_NEG: ret = -x
+            elif op == libopenreil.I_MUL: ret = x * y
+            elif op == libopenreil.I_SMUL: ret = x * y
+            elif op == libopenreil.I_SHL: ret = 0 if y >= 64 else x << y
+            elif op == libopenreil.I_SHR: ret = 0 if y >= 64 else x >> y
+            elif op == libopenreil.I_AND: ret = x & y
+            elif op == libopenreil.I_OR: ret = x | y
+            elif op == libopenreil.I_XOR: ret = x ^ y
+            elif op == libopenreil.I_NOT: ret = ~x
+            elif op == libopenreil.I_EQ: ret = 1 if x == y else 0
+            elif op == libopenreil.I_LT: ret = 1 if x < y else 0
+
+            elif op == libopenreil.I_DIV or op == libopenreil.I_MOD:
+
+                if y == 0: raise ZeroDivisionError('division by zero')
+                ret = x / y if op == libopenreil.I_DIV else x % y
+
+            elif op == libopenreil.I_SDIV or op == libopenreil.I_SMOD:
+
+                if y == 0: raise ZeroDivisionError('division by zero')
+                sx_x, sx_y = sx(x, insn.size), sx(y, insn.size)
+
+                if sx_y == -1:
+
+                    # INT64_MIN / -1 overflows, negate unsigned value instead
+                    ret = -x if op == libopenreil.I_SDIV else 0
+
+                else:
+
+                    # C division rounds towards zero, remainder has the sign of dividend
+                    sret = sx_x / sx_y if op == libopenreil.I_SDIV else sx_x % sx_y
+                    ret = <uint64_t>sret
+
+            self.set(&insn.c, ret & insn.mask)
+
+        return None
+
+    def run(self, cpu):
+
+        cdef list vals = cpu.reg_vals
+        cdef int i
+
+        # copy register values from the Cpu
+        for i in range(self.regs_count):
+
+            self.regs[i] = vals[self.reg_index[i]] & 0xffffffffffffffff
+            self.written[i] = 0
+
+        memset(self.temps, 0, (self.temps_count + 1) * sizeof(uint64_t))
+
+        try:
+
+            # returns address of the next instruction if JCC was taken
+            return self.execute(cpu.mem)
+
+        finally:
+
+            # copy modified register values back
+            for i in range(self.regs_count):
+
+                if self.written[i]: vals[self.reg_index[i]] = self.regs[i]
+
+#
+# EoF
+#
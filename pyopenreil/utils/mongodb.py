@@ -181,6 +181,7 @@ class CodeStorageMongo(REIL.CodeStorageMem):
     def clear(self): 
 
         self.cache.clear()
+        self.version += 1
 
         # remove all items of collection
         return self.collection.remove()
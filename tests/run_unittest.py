@@ -54,26 +54,12 @@ def check_nasm():
         print 'check_nasm(): Error while executing "%s"' % asm.NASM_PATH        
         return False
 
-def check_numpy():
-
-    try:
-        
-        import numpy
-        return True
-
-    except ImportError, why:
-
-        print str(why)
-        print 'check_numpy(): Error while loading numpy'
-        return False
-
 def main():
 
     ok = True
 
     # check for required programs and modules
     if not check_nasm(): ok = False
-    if not check_numpy(): ok = False
 
     if ok:
 
@@ -81,7 +67,7 @@ def main():
 
     else:
 
-        print 'Unable to run tests, check for installed nasm and python-numpy'
+        print 'Unable to run tests, check for installed nasm'
 
 if __name__ == '__main__':  
 